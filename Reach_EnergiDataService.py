@@ -1,14 +1,91 @@
 import os
+import orjson
 import requests
 import polars as pl
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Base URL for the API
+API_URL = 'https://api.energidataservice.dk/dataset/DatahubPricelist'
+PAGE_SIZE = 10000       # Records per request
+MAX_CONCURRENT_PAGES = 16  # Pages fetched in parallel
+
+# One pooled session for all requests: reuses TCP/TLS connections across pages and
+# retries transient API errors with exponential backoff
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=MAX_CONCURRENT_PAGES,
+    pool_maxsize=MAX_CONCURRENT_PAGES,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# Parquet cache settings: ZSTD compresses the repeated text columns well, and
+# per-row-group statistics let filtered scans skip whole row groups
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_COMPRESSION_LEVEL = 6
+PARQUET_ROW_GROUP_SIZE = 200_000
+
+# DatahubPricelist record schema. Giving it explicitly skips schema inference over all records.
+# Low-cardinality text columns are categoricals (dictionary-encoded in parquet).
+PRICELIST_SCHEMA = {
+    'ChargeOwner': pl.Categorical,
+    'GLN_Number': pl.String,
+    'ChargeType': pl.Categorical,
+    'ChargeTypeCode': pl.Categorical,
+    'Note': pl.String,
+    'Description': pl.String,
+    'ValidFrom': pl.String,
+    'ValidTo': pl.String,
+    'VATClass': pl.String,
+    **{f'Price{i}': pl.Float64 for i in range(1, 25)},
+    'TransparentInvoicing': pl.Int64,
+    'TaxIndicator': pl.Int64,
+    'ResolutionDuration': pl.String
+}
+
+# The offset pages are fetched concurrently, so the server must return every page in the same
+# order. Sorting on every record field leaves no ties between different records for it to break
+# differently from one request to the next (repeated records are caught after the fetch)
+API_SORT = ', '.join(f'{col} ASC' for col in PRICELIST_SCHEMA)
+
+# ValidFrom/ValidTo arrive as ISO strings; parsed once with a fixed format and stored typed
+DATE_COLUMNS = ['ValidFrom', 'ValidTo']
+API_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S%.f'
+
+def get_data_directory():
+    """Get Data directory parallel to script directory"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(os.path.dirname(script_dir), 'Data')
+
+def _fetch_page(params: dict, offset: int):
+    """Fetch one page of records from the API, starting at offset"""
+    response = _SESSION.get(API_URL, params={**params, 'offset': offset, 'limit': PAGE_SIZE})
+    response.raise_for_status()  # Raise an exception for bad responses
+    return orjson.loads(response.content)
+
+def _scan_cache(parquet_path: str):
+    """Lazy scan of the parquet cache that reads row group by row group, keeping memory bounded"""
+    return pl.scan_parquet(parquet_path, low_memory=True, parallel='row_groups')
+
+def _cache_covers(parquet_path: str, start_date: str, end_date: str):
+    """Check the date range stored in the parquet footer covers the requested range"""
+    metadata = pl.read_parquet_metadata(parquet_path)  # Footer only, no data pages
+    # Files written before the range was stored have no metadata and never match
+    if 'start_date' not in metadata or 'end_date' not in metadata:
+        return False
+    # YYYY-MM-DD strings compare in date order
+    return metadata['start_date'] <= start_date and metadata['end_date'] >= end_date
 
 def fetch_datahub_pricelist(
     start_date: str = '2021-01-01', 
     end_date: str = '2025-12-31', 
     parquet_path: Optional[str] = None, 
-    use_cached: bool = True
+    use_cached: bool = True,
+    write_csv: bool = False,
+    data_dir: Optional[str] = None
 ):
     """
     Fetch DatahubPricelist from Energi Dataservice API or load from parquet file.
@@ -17,81 +94,109 @@ def fetch_datahub_pricelist(
         start_date (str): Start date for data extraction (YYYY-MM-DD)
         end_date (str): End date for data extraction (YYYY-MM-DD)
         parquet_path (str, optional): Custom path for parquet file. 
-                                      If None, uses default 'datahub_pricelist.parquet' in Data folder
-        use_cached (bool): Whether to use existing parquet file if available
+                                      If None, uses 'datahub_pricelist_{start_date}_{end_date}.parquet' in Data folder
+        use_cached (bool): Whether to use existing parquet file if it covers the requested dates
+        write_csv (bool): Also write a CSV copy next to the parquet file (for reading by hand)
+        data_dir (str, optional): Folder for the parquet file. If None, uses the Data folder
+                                  parallel to the script folder
     
     Returns:
-        tuple: (Polars DataFrame with price data, directory path of the parquet file)
+        tuple: (Polars LazyFrame over the price data, directory path of the parquet file)
     """
-    # Get the directory where the script is located
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    # Create path to Data folder (parallel to script folder)
-    data_dir = os.path.join(os.path.dirname(script_dir), 'Data')
+    # Default to the Data folder (parallel to script folder)
+    if data_dir is None:
+        data_dir = get_data_directory()
     
     # Determine parquet file path
     if parquet_path is None:
-        parquet_path = os.path.join(data_dir, 'datahub_pricelist.parquet')
+        parquet_path = os.path.join(data_dir, f'datahub_pricelist_{start_date}_{end_date}.parquet')
     else:
-        # If custom path provided, ensure it's in the Data folder
+        # If custom path provided, ensure it's in the data folder
         filename = os.path.basename(parquet_path)
         parquet_path = os.path.join(data_dir, filename)
     
     # Ensure Data directory exists
     os.makedirs(data_dir, exist_ok=True)
     
-    # Check if cached parquet file exists and use_cached is True
+    # Check if cached parquet file exists, covers the requested dates and use_cached is True
     if use_cached and os.path.exists(parquet_path):
-        print(f"Loading data from existing parquet file: {parquet_path}")
         try:
-            return pl.read_parquet(parquet_path), data_dir
+            if _cache_covers(parquet_path, start_date, end_date):
+                print(f"Loading data from existing parquet file: {parquet_path}")
+                # Scan lazily so downstream projections/filters are pushed into the parquet reader
+                lf = _scan_cache(parquet_path)
+                lf.collect_schema()  # Reads only the footer, but surfaces a corrupt file here
+                return lf, data_dir
+            print(f"Existing parquet file does not cover {start_date} to {end_date}: {parquet_path}")
+            print("Fetching from API...")
         except Exception as e:
             print(f"Error reading parquet file: {e}")
             print("Falling back to API fetch...")
     
-    # Base URL for the API
-    base_url = 'https://api.energidataservice.dk/dataset/DatahubPricelist'
-    
     # Prepare query parameters
     params = {
         'start': start_date,
         'end': end_date,
-        'limit': 1000000000  # Increase limit to get more records
+        'sort': API_SORT
     }
     
     try:
-        # Send GET request to the API
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()  # Raise an exception for bad responses
+        # The first page also tells us how many records there are in total
+        first_page = _fetch_page(params, 0)
+        if 'total' not in first_page:
+            raise ValueError("API response has no 'total' - cannot tell how many pages to fetch")
+        total = first_page['total']
+        offsets = range(PAGE_SIZE, total, PAGE_SIZE)
         
-        # Parse JSON response
-        result = response.json()
+        # Fetch the remaining pages concurrently (map keeps them in offset order)
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES) as pool:
+            pages = [first_page] + list(pool.map(lambda offset: _fetch_page(params, offset), offsets))
         
         # Extract records
-        records = result.get('records', [])
+        records = [record for page in pages for record in page.get('records', [])]
         
         if not records:
             print("No records found in the specified date range.")
             return None, None
         
-        # Convert records to Polars DataFrame
-        df = pl.DataFrame(records)
+        # Never cache an incomplete download - its metadata would claim the full date range
+        if len(records) != total:
+            raise ValueError(f"Fetched {len(records)} records, but the API reported {total}")
         
-        # Optional: Convert date column to datetime if needed
-        if 'date' in df.columns:
-            df = df.with_columns(pl.col('date').str.to_datetime())
+        df = pl.from_dicts(records, schema=PRICELIST_SCHEMA)
+        
+        # A repeated record means the pages overlapped (and, with the count matching, another was skipped)
+        duplicates = df.is_duplicated().sum()
+        if duplicates:
+            raise ValueError(f"Fetched {duplicates} duplicate records - the pages overlap")
+        
+        # Build a lazy plan over the records so the writers stream it in chunks
+        lf = df.lazy()
+        
+        # Parse the dates here, so loading the parquet file never has to
+        lf = lf.with_columns(pl.col(DATE_COLUMNS).str.to_datetime(format=API_DATE_FORMAT))
         
         # Save to parquet for future use
-        df.write_parquet(parquet_path)
+        sinks = [lf.sink_parquet(parquet_path,
+                                 compression=PARQUET_COMPRESSION,
+                                 compression_level=PARQUET_COMPRESSION_LEVEL,
+                                 statistics=True,
+                                 row_group_size=PARQUET_ROW_GROUP_SIZE,
+                                 metadata={'start_date': start_date, 'end_date': end_date},
+                                 lazy=True)]
+        
+        # Optional CSV copy in the same Data directory, sunk from the same plan in one pass
+        if write_csv:
+            csv_path = parquet_path.replace('.parquet', '.csv')
+            sinks.append(lf.sink_csv(csv_path, lazy=True))
         
-        # Create CSV path in the same Data directory
-        csv_path = parquet_path.replace('.parquet', '.csv')
-        df.write_csv(csv_path)
+        pl.collect_all(sinks)
         
         print(f"Data saved to parquet file: {parquet_path}")
-        print(f"Data saved to CSV file: {csv_path}")
+        if write_csv:
+            print(f"Data saved to CSV file: {csv_path}")
         
-        return df, data_dir
+        return _scan_cache(parquet_path), data_dir
     
     except requests.RequestException as e:
         print(f"Error fetching data: {e}")
@@ -109,8 +214,9 @@ def main():
     )
     
     if df is not None:
-        pd_df = df.to_pandas()
-        print(f"Data successfully loaded. Shape: {pd_df.shape}")
+        # Shape from the parquet footer - no need to materialise the data
+        shape = (df.select(pl.len()).collect(engine='streaming').item(), len(df.collect_schema()))
+        print(f"Data successfully loaded. Shape: {shape}")
         print(f"Files saved in directory: {save_dir}")
     else:
         print("Failed to load data.")
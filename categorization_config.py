@@ -3,9 +3,13 @@ Categorization Pattern Configuration
 
 
 """
+from types import MappingProxyType
+
+import numpy as np
+import polars as pl
 
 # Kundetype patterns - most don't use ChargeType
-kundetype_priority = ['Note', 'Description','ChargeTypeCode']
+kundetype_priority = ('Note', 'Description','ChargeTypeCode')
 kundetype_patterns = {
     'A0': {
         'Note': [
@@ -134,7 +138,7 @@ kundetype_patterns = {
 }
 
 # Type patterns
-pris_element_priority = ['ChargeType',  'Note', 'Description','ChargeTypeCode']
+pris_element_priority = ('ChargeType',  'Note', 'Description','ChargeTypeCode')
 pris_element_patterns = {
     'Tarif': {
         'ChargeType': ['D03'],
@@ -232,7 +236,7 @@ pris_element_patterns = {
 
 # NEEDS TO BE IMPLEMENTED!!!
 # afregning patterns
-afregning_priority = ['Note', 'Description','ChargeTypeCode']
+afregning_priority = ('Note', 'Description','ChargeTypeCode')
 afregning_patterns = {
     'E01': { # Skabelonafregnet
         'Note': ['skabelon'],
@@ -254,7 +258,7 @@ afregning_patterns = {
 
 
 # bruger patterns
-bruger_priority = ['Note', 'Description']
+bruger_priority = ('Note', 'Description')
 bruger_fallback = 'Forbrug'
 bruger_patterns = {
     'Forbrug': { # E17
@@ -274,14 +278,14 @@ bruger_patterns = {
     }
 }
 
-Rabat_priority = ['Note', 'Description']
+Rabat_priority = ('Note', 'Description')
 Rabat_patterns = {
     "Rabat": { # 
         'Note': ['Rabat'],
         'Description': ['Rabat']
     }
 }
-net_priority = ['Note', 'Description']
+net_priority = ('Note', 'Description')
 net_patterns = {
     "Overliggende net": { # 
         'Note': ['Overliggende','Overordnet','mellemliggende'],
@@ -290,13 +294,78 @@ net_patterns = {
 }
 
 
+# Freeze the configuration - everything derived from it below is built once at import,
+# so the patterns must not be changed in place afterwards
+def freeze_patterns(category_patterns):
+    """Read-only copy of {category: {column: [patterns]}} with the lists as tuples"""
+    return MappingProxyType({category: MappingProxyType({column: tuple(patterns) for column, patterns in fields.items()})
+                             for category, fields in category_patterns.items()})
+
+kundetype_patterns = freeze_patterns(kundetype_patterns)
+pris_element_patterns = freeze_patterns(pris_element_patterns)
+afregning_patterns = freeze_patterns(afregning_patterns)
+bruger_patterns = freeze_patterns(bruger_patterns)
+Rabat_patterns = freeze_patterns(Rabat_patterns)
+net_patterns = freeze_patterns(net_patterns)
+
+
+# Compiled patterns - built once at import so categorization doesn't redo this per row
+def compile_patterns(category_patterns, column_priority):
+    """
+    Lowercase the patterns once and group them per column in priority order.
+
+    A pattern listed several times for a category (e.g. 'rådighedstarif') is a deliberate
+    weight, so duplicates are collapsed into (pattern, weight) pairs rather than dropped.
+
+    Returns:
+        (categories, [(column, distinct patterns in column, {category: ((pattern, weight), ...)},
+                       weights[pattern, category]), ...])
+        Categories with no patterns for a column are left out of its dict (they abstain).
+    """
+    columns = []
+    for column in column_priority:
+        by_category = {}
+        for category, fields in category_patterns.items():
+            weights = {}
+            for pattern in map(str.lower, fields.get(column, ())):
+                weights[pattern] = weights.get(pattern, 0) + 1
+            if weights:
+                by_category[category] = tuple(weights.items())
+        # Every distinct pattern of the column, so each is only searched for once per text
+        distinct = tuple(dict.fromkeys(pattern for patterns in by_category.values() for pattern, _ in patterns))
+        # Same weights as a dense [pattern, category] matrix, so counts are one matrix product
+        weights = np.zeros((len(distinct), len(category_patterns)), dtype=np.int64)
+        for j, category in enumerate(category_patterns):
+            for pattern, weight in by_category.get(category, ()):
+                weights[distinct.index(pattern), j] = weight
+        weights.flags.writeable = False
+        columns.append((column, distinct, MappingProxyType(by_category), weights))
+    return tuple(category_patterns), tuple(columns)
+
+kundetype_compiled = compile_patterns(kundetype_patterns, kundetype_priority)
+pris_element_compiled = compile_patterns(pris_element_patterns, pris_element_priority)
+bruger_compiled = compile_patterns(bruger_patterns, bruger_priority)
+Rabat_compiled = compile_patterns(Rabat_patterns, Rabat_priority)
+net_compiled = compile_patterns(net_patterns, net_priority)
+
+# Flat table of every distinct pattern per column across all rule sets, so each column
+# can be matched against all of its patterns in one vectorized pass
+pattern_table = pl.DataFrame(
+    [(column, pattern)
+     for _, columns in (kundetype_compiled, pris_element_compiled, bruger_compiled, Rabat_compiled, net_compiled)
+     for column, distinct, _, _ in columns
+     for pattern in distinct],
+    schema=['column', 'pattern'], orient='row'
+).unique(maintain_order=True)
+
+
 
 # System configuration
 
 
 
 
-OUTPUT_COLUMN_ORDER = [
+OUTPUT_COLUMN_ORDER = (
     'KundeType',
     'PrisElement',
     'Bruger',
@@ -306,7 +375,7 @@ OUTPUT_COLUMN_ORDER = [
     'ChargeOwner',
     'ValidFrom',
     'ValidTo'
-]
+)
 
 GRID_MAPPING_FILENAME = 'Netselskabs_koder.xlsx'
 DEFAULT_OUTPUT_FILENAME = 'tariff_categorization_results.xlsx'
@@ -5,35 +5,101 @@ import numpy as np
 
 # Import configuration
 from categorization_config import (
-    kundetype_patterns,
-    pris_element_patterns,
-    bruger_patterns,
-    net_patterns,
-    Rabat_patterns,
-    kundetype_priority,
-    pris_element_priority,
-    bruger_priority,
-    net_priority,
-    Rabat_priority,
+    kundetype_compiled,
+    pris_element_compiled,
+    bruger_compiled,
+    net_compiled,
+    Rabat_compiled,
+    pattern_table,
     OUTPUT_COLUMN_ORDER,
     DEFAULT_OUTPUT_FILENAME,
     use_temp_file
 )
-
-# ============================================
-# DIRECTORY HELPERS
-# ============================================
-
-def get_data_directory():
-    """Get Data directory parallel to script directory"""
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(os.path.dirname(script_dir), 'Data')
+from Reach_EnergiDataService import get_data_directory
 
 # ============================================
 # CATEGORIZATION FUNCTIONS
 # ============================================
 
-def find_category(row, category_patterns, COLUMN_PRIORITY_ORDER,fallback):
+def match_patterns(values, patterns):
+    """
+    Vectorized substring matching of every pattern against the distinct values of a column.
+    
+    Uses one overlapping Aho-Corasick scan per value (polars str.extract_many), so nested
+    patterns such as ' a ' inside 'a høj plus' are all reported.
+    
+    Args:
+        values: Column to match (lowercased polars String Series)
+        patterns: Lowercased patterns to search for
+    
+    Returns:
+        (index, hits, patterns): index[row] is the row's distinct value (null: the last, empty one)
+        and hits[value, pattern] whether the pattern is found in that value
+    """
+    distinct = values.drop_nulls().unique(maintain_order=True)
+    found = (
+        pl.DataFrame({'pattern': distinct.str.extract_many(patterns, overlapping=True)})
+        .with_row_index('value')
+        .explode('pattern')
+        .drop_nulls()
+        .with_columns(pl.col('pattern').replace_strict(patterns, range(len(patterns)), return_dtype=pl.Int64))
+    )
+    hits = np.zeros((len(distinct) + 1, len(patterns)), dtype=bool)
+    hits[found['value'].to_numpy(), found['pattern'].to_numpy()] = True
+    
+    index = (
+        values
+        .replace_strict(distinct, range(len(distinct)), default=len(distinct), return_dtype=pl.Int64)
+        .fill_null(len(distinct))
+        .to_numpy()
+    )
+    return index, hits, tuple(patterns)
+
+def resolve_matches(compiled_patterns, column_hits):
+    """
+    Weighted match count of every category of a rule set, for each distinct column value.
+    
+    Args:
+        compiled_patterns: Patterns from categorization_config.compile_patterns
+        column_hits: {column: (index, hits, patterns)} from match_patterns
+    
+    Returns:
+        {column: counts[value, category]} - values as in column_hits, categories in rule set order
+    """
+    _, columns = compiled_patterns
+    column_counts = {}
+    for column, patterns, _, weights in columns:
+        if column in column_hits:
+            _, hits, hit_patterns = column_hits[column]
+            column_counts[column] = hits[:, [hit_patterns.index(pattern) for pattern in patterns]].astype(np.int64) @ weights
+    return column_counts
+
+def categorize_single(columns_present, compiled_patterns, fallback):
+    """
+    Vectorized find_category for a rule set with a single category.
+    
+    With one category the cascade reduces to: the category wins as soon as any column
+    matches, otherwise the fallback. So it is a plain polars expression - one str.contains_any
+    (Aho-Corasick) scan per column - with no match resolution in Python.
+    
+    Args:
+        columns_present: Columns of the frame the expression is evaluated on
+        compiled_patterns: Patterns from categorization_config.compile_patterns
+        fallback: Category to return when nothing matches (None = "Uncategorized")
+    
+    Returns:
+        Polars expression giving the category name of each row
+    """
+    (category,), columns = compiled_patterns
+    masks = [pl.col(column).str.contains_any(list(patterns))
+             for column, patterns, _, _ in columns if column in columns_present]
+    return (
+        pl.when(pl.any_horizontal(masks) if masks else pl.lit(False))
+        .then(pl.lit(category))
+        .otherwise(pl.lit("Uncategorized - No matches" if fallback is None else fallback))
+    )
+
+def find_category(row, compiled_patterns, fallback):
     """
     Cascading filter with match counting: Categories compete based on number of pattern matches.
     
@@ -46,25 +112,27 @@ def find_category(row, category_patterns, COLUMN_PRIORITY_ORDER,fallback):
     4. Winner is determined by highest match count
     
     Args:
-        row: DataFrame row to categorize
-        category_patterns: {category: {column: [patterns]}}
-        COLUMN_PRIORITY_ORDER: List of columns to check in order
+        row: {column: patterns found in the row's value} for the row to categorize
+             (empty for missing/blank values)
+        compiled_patterns: Patterns from categorization_config.compile_patterns
+        fallback: Category to return when nothing matches (None = "Uncategorized")
     
     Returns:
         Category name or string of matching patterns
     """
 
-    candidates = list(category_patterns.keys())
+    categories, columns = compiled_patterns
+    candidates = list(categories)
     match_counts = {cat: 0 for cat in candidates}  # Track matches per category
     matching_patterns = []
     
-    for c, column in enumerate(COLUMN_PRIORITY_ORDER):
+    for column, _, category_patterns, _ in columns:
 
-        # Skip if column doesn't exist, is NaN, or is empty string
-        if column not in row or pd.isna(row[column]) or str(row[column]).strip() == '':
+        # Skip if column doesn't exist, is NaN/empty or matches nothing - candidates stay as they are
+        hits = row.get(column)
+        if not hits:
             continue
         
-        text = str(row[column]).lower()
         update_candidates = []
         
         # Loops through all candidates
@@ -72,22 +140,18 @@ def find_category(row, category_patterns, COLUMN_PRIORITY_ORDER,fallback):
         for category in candidates:
 
             # Get patterns for this category and column
-            if column not in category_patterns[category]:
-                update_candidates.append(category)
-                continue
-            
-            patterns = category_patterns[category][column]
+            patterns = category_patterns.get(category)
             
-            if not patterns:  # Empty list [] - category abstains
+            if not patterns:  # Missing or empty list [] - category abstains
                 update_candidates.append(category)
                 continue
             
             # Category has patterns - check ALL matches and count them
             has_match = False
-            for pattern in patterns:
-                if pattern.lower() in text:
-                    match_counts[category] += 1
-                    matching_patterns.append(pattern.lower())
+            for pattern, weight in patterns:
+                if pattern in hits:
+                    match_counts[category] += weight
+                    matching_patterns.extend([pattern] * weight)
                     has_match = True
                     
                     # DON'T break - count all matches
@@ -140,6 +204,78 @@ def find_category(row, category_patterns, COLUMN_PRIORITY_ORDER,fallback):
             else:
                 return "Uncategorized - No matches"
 
+def categorize_rule_set(text, compiled_patterns, column_hits, column_counts, fallback):
+    """
+    Vectorized find_category over all rows of text at once.
+    
+    Runs the same cascade column by column on (rows x categories) arrays: candidates still
+    in the running, their match counts, and the rows already decided by a single remaining
+    candidate. Only ties fall back to find_category, as their label lists the matched patterns.
+    
+    Args:
+        text: Polars DataFrame of the lowercased text columns (str, or null for missing/blank values)
+        compiled_patterns: Patterns from categorization_config.compile_patterns
+        column_hits: {column: (index, hits, patterns)} from match_patterns
+        column_counts: {column: counts[value, category]} from resolve_matches
+        fallback: Category to return when nothing matches (None = "Uncategorized")
+    
+    Returns:
+        Array of category names, one per row of text
+    """
+    categories, columns = compiled_patterns
+    n_rows, n_categories = text.height, len(categories)
+    
+    candidates = np.ones((n_rows, n_categories), dtype=bool)
+    match_counts = np.zeros((n_rows, n_categories), dtype=np.int64)
+    decided = np.zeros(n_rows, dtype=bool)  # Terminated early with a single candidate
+    
+    for column, _, _, weights in columns:
+        if column not in column_counts:
+            continue
+        
+        # Match count of every category for each distinct value
+        value_counts = column_counts[column]
+        
+        # No value of this column matches any category - it can't change any row
+        if not value_counts.any():
+            continue
+        
+        # Only rows still running whose value matches some category can change
+        index = column_hits[column][0]
+        active = np.flatnonzero(~decided & value_counts.any(axis=1)[index])
+        counts = value_counts[index[active]]
+        hits = counts > 0
+        
+        # Categories without patterns for this column abstain (stay)
+        abstains = ~weights.any(axis=0)
+        
+        # Rows where a candidate matches: count, then eliminate non-matching
+        active_candidates = candidates[active]
+        candidate_hits = active_candidates & hits
+        candidate_matches = candidate_hits.any(axis=1)
+        match_counts[active] += np.where(candidate_hits, counts, 0)
+        active_candidates = np.where(candidate_matches[:, None], active_candidates & (abstains | hits), active_candidates)
+        candidates[active] = active_candidates
+        
+        # If there is only one candidate and there was a match, terminate early
+        decided[active] |= candidate_matches & (active_candidates.sum(axis=1) == 1)
+    
+    # Highest match count among the remaining candidates (a decided row has one candidate)
+    candidate_counts = np.where(candidates, match_counts, -1)
+    winners = candidate_counts == candidate_counts.max(axis=1, initial=-1)[:, None]
+    single = decided | (winners.sum(axis=1) == 1)
+    no_matches = ~decided & (match_counts.sum(axis=1) == 0)
+    
+    labels = np.array(categories, dtype=object)[winners.argmax(axis=1)]
+    labels[no_matches] = "Uncategorized - No matches" if fallback is None else fallback
+    
+    # Ties: label (with the matched patterns) from the row-wise cascade
+    for row in np.flatnonzero(~single & ~no_matches):
+        row_hits = {column: frozenset(patterns[j] for j in np.flatnonzero(hits[index[row]]))
+                    for column, (index, hits, patterns) in column_hits.items()}
+        labels[row] = find_category(row_hits, compiled_patterns, fallback)
+    return labels
+
 # ============================================
 # MAIN FUNCTION
 # ============================================
@@ -158,15 +294,16 @@ def load_raw_tarif_data(input_file, output_dir):
     df = pl.read_parquet(input_file)
     print(f"Loaded {len(df)} rows")
     
-    # Convert date columns to datetime and format them immediately
+    # Convert date columns to datetime, unless the parquet file already stores them typed
     df = df.with_columns([
-        pl.col("ValidFrom").str.strptime(pl.Datetime, "%Y-%m-%dT%H:%M:%S%.f").dt.strftime("%Y-%m-%d %H:%M:%S").alias("ValidFrom"),
-        pl.when(pl.col("ValidTo").is_not_null())
-        .then((pl.col("ValidTo").str.strptime(pl.Datetime, "%Y-%m-%dT%H:%M:%S%.f") - pl.duration(hours=1)).dt.strftime("%Y-%m-%d %H:%M:%S"))
-        .otherwise(pl.col("ValidTo"))
-        .alias("ValidTo")
+        pl.col(col).str.strptime(pl.Datetime, "%Y-%m-%dT%H:%M:%S%.f")
+        for col in ["ValidFrom", "ValidTo"] if df.schema[col] == pl.String
     ])
     
+    # ValidTo is exclusive - make it the last hour of the period (null ValidTo stays null).
+    # Dates stay datetimes from here on; they are only formatted when written to Excel
+    df = df.with_columns(pl.col("ValidTo") - pl.duration(hours=1))
+    
     # Sort by ValidFrom to ensure chronological order
     df = df.sort("ValidFrom")
     
@@ -177,53 +314,41 @@ def load_raw_tarif_data(input_file, output_dir):
     # Non-price, non-date columns (these define the groups)
     id_cols = [col for col in df.columns if col not in date_cols and col not in price_cols]
     
-    # Group by ID columns and process
-    result_rows = []
-    
-    for group_keys, group_df in df.group_by(id_cols, maintain_order=True):
-        group_df = group_df.sort("ValidFrom")
-        group_data = group_df.to_dicts()
-        
-        i = 0
-        while i < len(group_data):
-            # Start a new period
-            current_row = group_data[i].copy()
-            current_prices = [current_row[col] for col in price_cols]
-            period_start = current_row['ValidFrom']
-            period_end = current_row['ValidTo']
-            
-            # Look ahead to find consecutive rows with same prices
-            j = i + 1
-            while j < len(group_data):
-                next_row = group_data[j]
-                next_prices = [next_row[col] for col in price_cols]
-                
-                # Check if all prices are the same
-                if current_prices == next_prices:
-                    # Extend the period
-                    period_end = max(period_end, next_row['ValidTo']) if next_row['ValidTo'] else period_end
-                    j += 1
-                else:
-                    # Prices changed, stop extending
-                    break
-            
-            # Create result row with extended date range
-            result_row = current_row.copy()
-            result_row['ValidFrom'] = period_start
-            result_row['ValidTo'] = period_end
-            result_rows.append(result_row)
-            
-            # Move to next distinct price period
-            i = j
+    # One integer key per group of ID columns: the row number of its first row, so groups
+    # keep their order of first appearance. Sorted by group, rows are in chronological order
+    df_sorted = (
+        df.with_row_index('group_id')
+        .with_columns(pl.col('group_id').first().over(id_cols))
+        .sort(['group_id', 'ValidFrom'], maintain_order=True)
+    )
     
-    # Create result dataframe
-    df_result = pl.DataFrame(result_rows)
+    # Mark start of NEW price period:
+    # - First row in group
+    # - OR any price differs from the previous row (missing prices compare equal)
+    df_sorted = df_sorted.with_columns([
+        (
+            pl.col('group_id').ne_missing(pl.col('group_id').shift(1)) |
+            pl.any_horizontal([pl.col(col).ne_missing(pl.col(col).shift(1)) for col in price_cols])
+        )
+        .cum_sum()
+        .alias('period_id')
+    ])
     
-    # Restore original column order
-    df_result = df_result.select(df.columns)
+    # Merge each run of consecutive rows with the same prices into its first row,
+    # extended to the latest ValidTo of the run (missing ValidTo are ignored)
+    df_result = (
+        df_sorted
+        .group_by('period_id', maintain_order=True)
+        .agg([
+            pl.all().exclude('ValidTo').first(),
+            pl.col('ValidTo').max()
+        ])
+        .select(df.columns)  # Restore original column order
+    )
 
-    temp_path = os.path.join(output_dir, 'temp.csv')
-    df_result.write_csv(temp_path)
+    # Intermediate result as Parquet: keeps the dtypes and is far cheaper to write and read back than CSV
+    temp_path = os.path.join(output_dir, 'temp.parquet')
+    df_result.write_parquet(temp_path, compression='zstd')
 
     print(f"After deduplication: {len(df_result)} rows (was {len(df)} rows)")
 
@@ -235,32 +360,62 @@ def categorize_tariff_data(df):
     Main categorization function
     
     Args:
-        input_file: Path to input CSV file
-        output_file: Output filename (default from config)
-        use_data_folder: If True, save to Data folder; if False, save to same dir as input
+        df: Polars DataFrame of tariffs (from load_raw_tarif_data)
+    
+    Returns:
+        Polars DataFrame with the category columns added in front
     """
     
     
     # Categorize
     print("Categorizing...")
-    df['KundeType'] = df.apply(lambda row: find_category(row, kundetype_patterns,kundetype_priority,None), axis=1)
-    df['PrisElement'] = df.apply(lambda row: find_category(row, pris_element_patterns,pris_element_priority,None), axis=1)
-    df['OverliggendeNet'] = df.apply(lambda row: find_category(row, net_patterns,net_priority,"Eget net"), axis=1)
-    df['Rabat'] = df.apply(lambda row: find_category(row, Rabat_patterns,Rabat_priority,"Normal"), axis=1)
-    df['Bruger'] = df.apply(lambda row: find_category(row, bruger_patterns,bruger_priority,"Forbrug"), axis=1)
+    
+    # Distinct combinations of the text columns, taken on the stored dtypes (categorical codes
+    # for ChargeType/ChargeTypeCode) - all string work below is done once per combination
+    text_columns = [column for column in pattern_table['column'].unique(maintain_order=True) if column in df.columns]
+    keys = df.select(text_columns).unique(maintain_order=True)
+    
+    # As lowercased plain strings - shared by every rule set, so each column is lowered once -
+    # with blank values set to null once per column so rows don't have to strip and compare them
+    text = keys.with_columns(pl.col(column).cast(pl.String) for column in text_columns)
+    text = text.with_columns(pl.when(pl.col(column).str.strip_chars() != '').then(pl.col(column).str.to_lowercase()).alias(column)
+                             for column in text_columns)
+    
+    # Match every pattern against the distinct values of each text column up front
+    column_hits = {}
+    for (column,), patterns in pattern_table.group_by('column', maintain_order=True):
+        if column in text.columns:
+            column_hits[column] = match_patterns(text[column], patterns['pattern'].to_list())
+    
+    # Weighted match counts of each rule set's categories per distinct value
+    kundetype_counts = resolve_matches(kundetype_compiled, column_hits)
+    pris_element_counts = resolve_matches(pris_element_compiled, column_hits)
+    bruger_counts = resolve_matches(bruger_compiled, column_hits)
+    
+    # Categorize each distinct combination once, then join the labels back to the rows
+    labels = keys.with_columns(
+        pl.Series('KundeType', categorize_rule_set(text, kundetype_compiled, column_hits, kundetype_counts, None), dtype=pl.String),
+        pl.Series('PrisElement', categorize_rule_set(text, pris_element_compiled, column_hits, pris_element_counts, None), dtype=pl.String),
+        pl.Series('Bruger', categorize_rule_set(text, bruger_compiled, column_hits, bruger_counts, "Forbrug"), dtype=pl.String),
+        *text.select(
+            categorize_single(text_columns, net_compiled, "Eget net").alias('OverliggendeNet'),
+            categorize_single(text_columns, Rabat_compiled, "Normal").alias('Rabat')
+        )
+    )
+    df = df.join(labels, on=text_columns, how='left', nulls_equal=True, maintain_order='left')
 
     # Reorder columns
     priority_cols = [col for col in OUTPUT_COLUMN_ORDER if col in df.columns]
     other_cols = [col for col in df.columns if col not in priority_cols]
-    df = df[priority_cols + other_cols]
+    df = df.select(priority_cols + other_cols)
     
     # Statistics
     print(f"\nResults:")
-    print(f"  KundeType: {df['KundeType'].value_counts().to_dict()}")
-    print(f"  PrisElement: {df['PrisElement'].value_counts().to_dict()}")
-    print(f"  OverliggendeNet: {df['OverliggendeNet'].value_counts().to_dict()}")  
-    print(f"  Rabat: {df['Rabat'].value_counts().to_dict()}")  
-    print(f"  Bruger: {df['Bruger'].value_counts().to_dict()}")
+    # Counts of all label columns in one parallel select
+    label_cols = ['KundeType', 'PrisElement', 'OverliggendeNet', 'Rabat', 'Bruger']
+    value_counts = df.select([pl.col(col).value_counts(sort=True).implode() for col in label_cols]).row(0, named=True)
+    for col in label_cols:
+        print(f"  {col}: {dict((count[col], count['count']) for count in value_counts[col])}")
     
     
     return df
@@ -274,12 +429,6 @@ def merge_only_overlapping_periods(df_pl,COLUMNS,col_groupby):
         #col_groupby = ['KundeType', 'PrisElement', 'ChargeOwner','Bruger']
         price_cols = [f'Price{i}' for i in range(1, 25)]
         
-        # Parse dates if needed (adjust format as needed)
-        df_pl = df_pl.with_columns([
-            pl.col('ValidFrom').str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S"),
-            pl.col('ValidTo').str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S")
-        ])
-        
         # Sort: ValidFrom ascending, ValidTo descending
         df_sorted = df_pl.sort(
             col_groupby + price_cols + ['ValidFrom', 'ValidTo'],
@@ -332,6 +481,25 @@ def merge_only_overlapping_periods(df_pl,COLUMNS,col_groupby):
         return result
 
 
+# Display format of datetime cells in the Excel output
+EXCEL_DATETIME_FORMAT = 'yyyy-mm-dd hh:mm:ss'
+
+def write_excel(df, output_path, sheet_name):
+    """
+    Write a polars DataFrame to a single Excel sheet.
+    
+    The frame only goes to pandas here, Arrow-backed so the columns aren't copied into Python
+    objects. The cells aren't scanned for formulas/URLs. Datetime columns are written as Excel
+    dates, displayed in the same format the dates had as text.
+    """
+    # No constant_memory: pandas writes column by column, and that mode drops every cell
+    # written to a row that has already been flushed
+    options = {'strings_to_formulas': False, 'strings_to_urls': False}
+    with pd.ExcelWriter(output_path, engine='xlsxwriter', datetime_format=EXCEL_DATETIME_FORMAT,
+                        engine_kwargs={'options': options}) as writer:
+        df.to_pandas(use_pyarrow_extension_array=True).to_excel(writer, sheet_name=sheet_name, index=False)
+
+
 # ============================================
 # MAIN EXECUTION
 # ============================================
@@ -339,8 +507,8 @@ def merge_only_overlapping_periods(df_pl,COLUMNS,col_groupby):
 def main():
     """Standalone execution"""
 
-    #row = pd.DataFrame({'Note':['Nettarif B lav produktion time'],'Description':['Tarif, egenproduktion (time)']})
-    #find_category(row.iloc[0], kundetype_patterns,kundetype_priority)
+    #row = {'Note':'Nettarif B lav produktion time','Description':'Tarif, egenproduktion (time)'}
+    #find_category(row, kundetype_compiled, None)
 
     data_dir = get_data_directory()
     input_file = os.path.join(data_dir, 'Tarif_data_2021_Maj2025.parquet')
@@ -366,19 +534,20 @@ def main():
     output_path = os.path.join(output_dir, output_file)
 
     if use_temp_file:
-        temp_file_path = os.path.join(output_dir,'temp.csv')
-        df = pd.read_csv(temp_file_path)
+        temp_file_path = os.path.join(output_dir,'temp.parquet')
+        df = pl.read_parquet(temp_file_path)
     else:
         df = load_raw_tarif_data(
             input_file=input_file,
             output_dir=output_dir)
     
-    df = df.to_pandas()
     df = categorize_tariff_data(df)
 
-    # Save
+    # Save - Parquet copy of the full result (columnar, far faster than the Excel writer to write and read back)
+    df.write_parquet(output_path.replace('.xlsx', '.parquet'), compression='zstd')
+
     print(f"\nSaving to: {output_path}")
-    df.to_excel(output_path, sheet_name='Categorized Data', index=False)
+    write_excel(df, output_path, 'Categorized Data')
     
     
 
@@ -388,9 +557,6 @@ def main():
         # Remove duplicates
     # Check if Price1 to Price24 are the same. If so remove the duplicate
 
-    df_pl = pl.from_pandas(df)
-    
-
     COLUMNS = [
     'KundeType',
     'PrisElement',
@@ -410,17 +576,14 @@ def main():
     col_groupby = ['KundeType', 'PrisElement', 'ChargeOwner','OverliggendeNet','Rabat','Bruger']
 
     # Use it
-    df_merged = merge_only_overlapping_periods(df_pl,COLUMNS,col_groupby)
-    print(f"Original rows: {len(df_pl)}")
+    df_merged = merge_only_overlapping_periods(df,COLUMNS,col_groupby)
+    print(f"Original rows: {len(df)}")
     print(f"After merging overlaps: {len(df_merged)}")
 
-    # Convert back to pandas if needed
-    df = df_merged.to_pandas()
-
-    print(df.head())
-    print(f"\nShape: {df.shape}")
+    print(df_merged.head())
+    print(f"\nShape: {df_merged.shape}")
     output_path = os.path.join(output_dir, 'cleaned.xlsx')
-    df.to_excel(output_path, sheet_name='Data', index=False)
+    write_excel(df_merged, output_path, 'Data')
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 import os
 import sys
+import polars as pl
 
 # Add the script's directory to Python path to ensure imports work
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -7,7 +8,7 @@ if script_dir not in sys.path:
     sys.path.insert(0, script_dir)
 
 from Reach_EnergiDataService import fetch_datahub_pricelist
-from categorize_tariffs import categorize_tariff_data,load_raw_tarif_data
+from categorize_tariffs import categorize_tariff_data,load_raw_tarif_data,write_excel
 from categorization_config import (
     DEFAULT_OUTPUT_FILENAME,
 )
@@ -55,7 +56,7 @@ def main():
         return
     
     print(f"✅ Data fetched successfully!")
-    print(f"   Records: {len(df)}")
+    print(f"   Records: {df.select(pl.len()).collect(engine='streaming').item()}")
     
     # STEP 2: Categorize data
     print(f"\n[STEP 2/2] Categorizing tariff data...")
@@ -68,12 +69,12 @@ def main():
         input_file=input_file,
         output_dir=data_dir)
     
-    df = df.to_pandas()
     df = categorize_tariff_data(df)
-    output_path = data_dir + output_file
-    # Save
-    print(f"\nSaving to: {data_dir}")
-    df.to_excel(output_path, sheet_name='Categorized Data', index=False)
+    output_path = os.path.join(data_dir, output_file)
+    # Save - Parquet copy of the full result (columnar, far faster than the Excel writer to write and read back)
+    df.write_parquet(output_path.replace('.xlsx', '.parquet'), compression='zstd')
+    print(f"\nSaving to: {output_path}")
+    write_excel(df, output_path, 'Categorized Data')
 
     
 